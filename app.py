@@ -1,22 +1,31 @@
+import io
 import os
 import re
 import logging
+import multiprocessing
 import asyncio
-from typing import List, Dict
-from collections import defaultdict
+import hashlib
+import threading
+import time
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
 from telegram import Update, InputFile, Bot
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-from PyPDF2 import PdfReader
-from transformers import pipeline
+import fitz
 from gtts import gTTS
 from flask import Flask, request, jsonify
 import openai
+import tiktoken
 
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL") or "gpt-4o-mini"
 
 if not TOKEN or not WEBHOOK_URL:
     raise RuntimeError("TELEGRAM_BOT_TOKEN and WEBHOOK_URL must be set in environment variables or .env file.")
@@ -25,127 +34,273 @@ if not TOKEN or not WEBHOOK_URL:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# PDF text extraction
-def extract_text_from_pdf(file_path: str) -> str:
-    text = ""
+# OpenAI client, created once at import so every request reuses its connection pool
+openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+OPENAI_MAX_CONCURRENCY = 4
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+# Instructions go in one system message; each chunk is sent as the user message
+SUMMARY_INSTRUCTIONS = (
+    "As an expert oil market trader, summarize the document sent by the user. "
+    "Focus on key trading insights, market trends, and actionable information. "
+    "If possible, mention any sources or references found in the document."
+)
+SUMMARY_MAX_TOKENS = 300
+SHORT_DOC_WORDS = 200
+try:
+    encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+except KeyError:
+    encoding = tiktoken.get_encoding("cl100k_base")
+
+# Context window per model; unknown models get gpt-3.5-turbo's 16k unless OPENAI_CONTEXT_TOKENS is set
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-3.5-turbo": 16385,
+}
+CONTEXT_TOKENS = int(os.getenv("OPENAI_CONTEXT_TOKENS") or MODEL_CONTEXT_TOKENS.get(OPENAI_MODEL, 16385))
+
+# Chunks are sized in model tokens to fill the context after the instructions,
+# the reply and a margin for message framing and tokenizer differences
+MAX_CHUNK_TOKENS = CONTEXT_TOKENS - len(encoding.encode_ordinary(SUMMARY_INSTRUCTIONS)) - SUMMARY_MAX_TOKENS - 256
+
+# PDF text extraction, one page at a time
+def iter_pdf_pages(data: bytes, name: str) -> Iterator[str]:
     try:
-        with open(file_path, 'rb') as f:
-            reader = PdfReader(f)
-            for page in reader.pages:
-                text += page.extract_text() or ""
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            for page in doc:
+                yield page.get_text("text")
     except Exception as e:
-        logger.error(f"Error extracting text from {file_path}: {e}")
-    return text
+        logger.error(f"Error extracting text from {name}: {e}")
+
+# Sentence boundary: spaces after terminal punctuation. Compiled once at import.
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?]) +')
 
-# Chunk text for summarization
-def chunk_text(text: str, max_chunk: int = 1024) -> List[str]:
-    sentences = re.split(r'(?<=[.!?]) +', text)
+# Chunk page texts for summarization, packing whole sentences up to max_tokens
+def chunk_text(pages: Iterable[str], max_tokens: int = MAX_CHUNK_TOKENS) -> List[str]:
     chunks = []
-    current = ""
-    for sentence in sentences:
-        if len(current) + len(sentence) > max_chunk:
-            chunks.append(current)
-            current = sentence
-        else:
-            current += (" " if current else "") + sentence
+    current = []
+    current_tokens = 0
+    for page in pages:
+        # Encode on this thread: each PDF worker process should use one core, not start a pool per page
+        for sentence in SENTENCE_SPLIT_RE.split(page):
+            ids = encoding.encode_ordinary(sentence)
+            n_tokens = len(ids)
+            if current and current_tokens + n_tokens > max_tokens:
+                chunks.append(" ".join(current))
+                current = []
+                current_tokens = 0
+            if n_tokens > max_tokens:
+                # Run-on text without sentence breaks (tables, bad OCR) is cut on token boundaries
+                for start in range(0, len(ids), max_tokens):
+                    chunks.append(encoding.decode(ids[start:start + max_tokens]))
+                continue
+            current.append(sentence)
+            current_tokens += n_tokens
     if current:
-        chunks.append(current)
-    return chunks
+        chunks.append(" ".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+# Runs in the PDF worker processes, so tokenization stays off the bot's event loop process.
+# Returns every chunk, i.e. the whole document's text, pickled back to the parent.
+def extract_chunks_from_pdf(data: bytes, name: str) -> List[str]:
+    return chunk_text(iter_pdf_pages(data, name))
+
+async def summarize_chunk(chunk: str) -> str:
+    async with openai_semaphore:
+        response = await openai_client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                {"role": "user", "content": chunk},
+            ],
+            max_tokens=SUMMARY_MAX_TOKENS,
+            temperature=0.3
+        )
+    return response.choices[0].message.content.strip()
 
 # Summarization using OpenAI ChatGPT API
-def summarize_text(text: str) -> str:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+async def summarize_text(chunks: List[str]) -> str:
+    # A document shorter than a summary is read out as-is; maxsplit stops counting early on long text
+    if len(chunks) == 1 and len(chunks[0].split(maxsplit=SHORT_DOC_WORDS)) < SHORT_DOC_WORDS:
+        print("[OPENAI] Document is short, skipping summarization.")
+        return "Oil Market Trader Summary:\n" + chunks[0].strip()
+    if openai_client is None:
         logger.error("OPENAI_API_KEY not set in environment.")
         return "[Error: No OpenAI API key configured.]"
-    openai.api_key = api_key
-    prompt = (
-        "As an expert oil market trader, summarize the following document. "
-        "Focus on key trading insights, market trends, and actionable information. "
-        "If possible, mention any sources or references found in the document.\n\n"
-        f"Document:\n{text}\n\nSummary:"
-    )
-    print("[OPENAI] Sending summarization request to OpenAI API...")
+    print(f"[OPENAI] Sending {len(chunks)} summarization request(s) to OpenAI API...")
     try:
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=300,
-            temperature=0.3
-        )
-        summary = response.choices[0].message.content.strip()
+        summaries = await asyncio.gather(*(summarize_chunk(chunk) for chunk in chunks))
         print("[OPENAI] Received summary from OpenAI API.")
-        return "Oil Market Trader Summary:\n" + summary
+        return "Oil Market Trader Summary:\n" + "\n".join(summaries)
     except Exception as e:
         logger.error(f"OpenAI API call failed: {e}")
         return "[Error: OpenAI summarization failed.]"
 
 # Text-to-speech
-def text_to_speech(text: str, output_path: str) -> str:
+def text_to_speech(text: str) -> Optional[bytes]:
+    buf = io.BytesIO()
     try:
         tts = gTTS(text)
-        tts.save(output_path)
+        tts.write_to_fp(buf)
     except Exception as e:
         logger.error(f"TTS failed: {e}")
-    return output_path
+        return None
+    return buf.getvalue()
+
+# Content hash of a downloaded PDF
+def hash_pdf(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 # File name sanitization
+UNSAFE_FILENAME_RE = re.compile(r'[^a-zA-Z0-9_.-]')
+
 def sanitize_filename(filename: str) -> str:
-    return re.sub(r'[^a-zA-Z0-9_.-]', '_', filename)
+    return UNSAFE_FILENAME_RE.sub('_', filename)
 
 # Per-user PDF queues and timers
-user_pdf_queues: Dict[int, List[str]] = defaultdict(list)
+# Each queued PDF is (file name, task preparing it in the background)
+user_pdf_queues: Dict[int, List[Tuple[str, asyncio.Task]]] = defaultdict(list)
 user_timers: Dict[int, asyncio.Task] = {}
+user_deadlines: Dict[int, float] = {}
+DEBOUNCE_SECONDS = 3
 MAX_PDFS_PER_USER = 5
 MAX_FILE_SIZE_MB = 10
 
-async def process_user_pdfs(user_id: int, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    pdf_paths = user_pdf_queues[user_id]
-    summaries = []
+# Summaries keyed by PDF content hash, so a resent PDF skips extraction and summarization
+summary_cache: "OrderedDict[str, str]" = OrderedDict()
+SUMMARY_CACHE_SIZE = 256
+
+def cache_summary(digest: str, summary: str):
+    summary_cache[digest] = summary
+    summary_cache.move_to_end(digest)
+    while len(summary_cache) > SUMMARY_CACHE_SIZE:
+        summary_cache.popitem(last=False)
+
+# PyMuPDF is not thread-safe, so PDFs are parsed in worker processes. They are forked on
+# purpose: spawn/forkserver would re-import this module and repeat its startup side effects.
+PDF_WORKER_CONTEXT = multiprocessing.get_context("fork")
+PDF_WORKERS = min(MAX_PDFS_PER_USER, os.cpu_count() or 1)
+
+def new_pdf_executor(max_workers: int = PDF_WORKERS) -> ProcessPoolExecutor:
+    executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=PDF_WORKER_CONTEXT)
+    # A fork-context pool forks all its workers on the first submit; do it now
+    executor.submit(int)
+    return executor
+
+# Created at import so the workers fork before the bot loop and Flask threads start
+pdf_executor = new_pdf_executor()
+
+# A worker killed by MuPDF (segfault, OOM) breaks the whole pool; swap in a fresh one once
+def replace_broken_pdf_executor(broken: ProcessPoolExecutor):
+    global pdf_executor
+    if pdf_executor is broken:
+        logger.warning("PDF worker pool broke; starting a new one.")
+        pdf_executor = new_pdf_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+# Hash a downloaded PDF, then take its cached summary or extract its text chunks
+async def prepare_pdf(data: bytes, name: str) -> Tuple[str, Optional[str], List[str]]:
+    digest = await asyncio.to_thread(hash_pdf, data)
+    cached = summary_cache.get(digest)
+    if cached is not None:
+        return digest, cached, []
+    loop = asyncio.get_running_loop()
+    executor = pdf_executor
     try:
-        print(f"[PROCESS] Starting processing for user {user_id} with {len(pdf_paths)} PDFs.")
-        await context.bot.send_message(chat_id=chat_id, text=f"⏳ Processing {len(pdf_paths)} PDF(s)...")
-        for idx, file_path in enumerate(pdf_paths, 1):
-            print(f"[PROCESS] Extracting text from PDF {idx}/{len(pdf_paths)}: {file_path}")
-            await context.bot.send_message(chat_id=chat_id, text=f"Extracting text from PDF {idx}/{len(pdf_paths)}...")
-            text = extract_text_from_pdf(file_path)
-            if text.strip():
-                print(f"[PROCESS] Summarizing PDF {idx}/{len(pdf_paths)}.")
-                await context.bot.send_message(chat_id=chat_id, text=f"Summarizing PDF {idx}/{len(pdf_paths)}...")
-                summary = summarize_text(text)
-                summaries.append(summary)
-            else:
-                logger.warning(f"No text extracted from {file_path}")
-                await context.bot.send_message(chat_id=chat_id, text=f"No text could be extracted from PDF {idx}.")
-    finally:
-        for file_path in pdf_paths:
-            try:
-                os.remove(file_path)
-                print(f"[CLEANUP] Deleted file: {file_path}")
-            except Exception as e:
-                logger.error(f"Failed to delete {file_path}: {e}")
-        user_pdf_queues[user_id] = []
-        user_timers.pop(user_id, None)
+        chunks = await loop.run_in_executor(executor, extract_chunks_from_pdf, data, name)
+    except BrokenProcessPool as e:
+        logger.error(f"PDF worker crashed while extracting text from {name}: {e}")
+        replace_broken_pdf_executor(executor)
+        # A crash fails every PDF in flight; retry each alone so only the culprit crashes again.
+        # If it does, BrokenProcessPool reaches process_user_pdfs, which asks for a resend.
+        isolated = new_pdf_executor(max_workers=1)
+        try:
+            chunks = await loop.run_in_executor(isolated, extract_chunks_from_pdf, data, name)
+        finally:
+            isolated.shutdown(wait=False)
+    except Exception as e:
+        logger.error(f"Error extracting text from {name}: {e}")
+        return digest, None, []
+    return digest, None, chunks
+
+async def process_user_pdfs(user_id: int, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    queue = user_pdf_queues.pop(user_id, [])
+    print(f"[PROCESS] Starting processing for user {user_id} with {len(queue)} PDFs.")
+    await context.bot.send_message(chat_id=chat_id, text=f"⏳ Processing {len(queue)} PDF(s)...")
+    print(f"[PROCESS] Waiting for text extraction of {len(queue)} PDF(s).")
+    await context.bot.send_message(chat_id=chat_id, text=f"Extracting text from {len(queue)} PDF(s)...")
+    # A failed PDF must not take the rest of the batch down with it
+    prepared = await asyncio.gather(*(task for _, task in queue), return_exceptions=True)
+    results: Dict[int, str] = {}
+    documents = []
+    # The same PDF sent twice in one burst is summarized once; later copies reuse that summary
+    first_idx_by_digest: Dict[str, int] = {}
+    duplicates: Dict[int, int] = {}
+    for idx, ((name, _), outcome) in enumerate(zip(queue, prepared), 1):
+        if isinstance(outcome, BrokenProcessPool):
+            await context.bot.send_message(chat_id=chat_id, text=f"Processing PDF {idx} failed, please resend it.")
+            continue
+        if isinstance(outcome, BaseException):
+            logger.error(f"Failed to prepare {name}: {outcome}")
+            await context.bot.send_message(chat_id=chat_id, text=f"No text could be extracted from PDF {idx}.")
+            continue
+        digest, cached, chunks = outcome
+        if cached is not None:
+            print(f"[CACHE] Reusing cached summary for PDF {idx}/{len(queue)}.")
+            if digest in summary_cache:
+                summary_cache.move_to_end(digest)
+            results[idx] = cached
+        elif digest in first_idx_by_digest:
+            print(f"[PROCESS] PDF {idx}/{len(queue)} duplicates PDF {first_idx_by_digest[digest]}.")
+            duplicates[idx] = first_idx_by_digest[digest]
+        elif chunks:
+            first_idx_by_digest[digest] = idx
+            documents.append((idx, digest, chunks))
+        else:
+            logger.warning(f"No text extracted from {name}")
+            await context.bot.send_message(chat_id=chat_id, text=f"No text could be extracted from PDF {idx}.")
+    if documents:
+        # Summarize every PDF in one batch instead of one request at a time
+        print(f"[PROCESS] Summarizing {len(documents)} PDF(s) in one batch.")
+        await context.bot.send_message(chat_id=chat_id, text=f"Summarizing {len(documents)} PDF(s)...")
+        new_summaries = await asyncio.gather(*(summarize_text(chunks) for _, _, chunks in documents))
+        for (idx, digest, _), summary in zip(documents, new_summaries):
+            if not summary.startswith("[Error"):
+                cache_summary(digest, summary)
+            results[idx] = summary
+    for idx, first_idx in duplicates.items():
+        results[idx] = results[first_idx]
+    summaries = [results[idx] for idx in sorted(results)]
     if summaries:
         combined_summary = '\n'.join(summaries)
-        audio_path = f"./tmp/{user_id}_summary.mp3"
         print(f"[PROCESS] Generating audio summary for user {user_id}.")
         await context.bot.send_message(chat_id=chat_id, text="Generating audio summary...")
-        text_to_speech(combined_summary, audio_path)
-        try:
-            with open(audio_path, 'rb') as audio_file:
-                print(f"[SEND] Sending audio summary to user {user_id}.")
-                await context.bot.send_voice(chat_id=chat_id, voice=audio_file)
-                await context.bot.send_message(chat_id=chat_id, text="✅ Summary audio sent!")
-        finally:
-            try:
-                os.remove(audio_path)
-                print(f"[CLEANUP] Deleted audio file: {audio_path}")
-            except Exception as e:
-                logger.error(f"Failed to delete {audio_path}: {e}")
+        audio = await asyncio.to_thread(text_to_speech, combined_summary)
+        if audio is None:
+            await context.bot.send_message(chat_id=chat_id, text="Could not generate the audio summary.")
+            return
+        print(f"[SEND] Sending audio summary to user {user_id}.")
+        # InputFile uploads bytes as-is; a file object would be read into a second copy first
+        await context.bot.send_voice(chat_id=chat_id, voice=InputFile(audio, filename="summary.mp3"))
+        await context.bot.send_message(chat_id=chat_id, text="✅ Summary audio sent!")
     else:
         await context.bot.send_message(chat_id=chat_id, text="Could not extract text from the PDFs.")
 
+# Wait until the user's debounce deadline passes, then process their queue.
+# New PDFs only push the deadline back; this one task keeps waiting.
+async def debounce_user_pdfs(user_id: int, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    print(f"[TIMER] Started {DEBOUNCE_SECONDS}-second timer for user {user_id}.")
+    while True:
+        remaining = user_deadlines[user_id] - time.monotonic()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(remaining)
+    user_deadlines.pop(user_id, None)
+    user_timers.pop(user_id, None)
+    await process_user_pdfs(user_id, chat_id, context)
+
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
@@ -163,30 +318,24 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     file = await context.bot.get_file(document.file_id)
     safe_name = sanitize_filename(f"{user_id}_{document.file_name}")
-    file_path = f"./tmp/{safe_name}"
-    await file.download_to_drive(file_path)
-    user_pdf_queues[user_id].append(file_path)
+    buf = io.BytesIO()
+    await file.download_to_memory(buf)
+    # Start hashing and extraction now, overlapping with the user's next downloads
+    user_pdf_queues[user_id].append((safe_name, asyncio.create_task(prepare_pdf(buf.getvalue(), safe_name))))
     print(f"[QUEUE] Added PDF to queue for user {user_id}. Queue length: {len(user_pdf_queues[user_id])}")
-    await update.message.reply_text(f"PDF received! Waiting for more... (Send more PDFs or wait 3 seconds to process)")
-    # Cancel previous timer if exists
-    if user_id in user_timers:
-        user_timers[user_id].cancel()
-        print(f"[TIMER] Cancelled previous timer for user {user_id}.")
-    # Start a new timer
-    async def timer():
-        try:
-            print(f"[TIMER] Started 3-second timer for user {user_id}.")
-            await asyncio.sleep(3)
-            await process_user_pdfs(user_id, chat_id, context)
-        except asyncio.CancelledError:
-            print(f"[TIMER] Timer cancelled for user {user_id}.")
-    user_timers[user_id] = asyncio.create_task(timer())
+    await update.message.reply_text(f"PDF received! Waiting for more... (Send more PDFs or wait {DEBOUNCE_SECONDS} seconds to process)")
+    # Push back the deadline; start the user's timer task only if none is running
+    user_deadlines[user_id] = time.monotonic() + DEBOUNCE_SECONDS
+    if user_id not in user_timers:
+        user_timers[user_id] = asyncio.create_task(debounce_user_pdfs(user_id, chat_id, context))
+    else:
+        print(f"[TIMER] Extended timer for user {user_id}.")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "👋 Welcome to the Oil Market PDF Summarizer Bot!\n\n"
         "Send me one or more PDF documents related to the oil market.\n"
-        "After you stop sending PDFs for 3 seconds, I will summarize all of them in the context of an oil market trader, focusing on key trading insights, market trends, and actionable information.\n\n"
+        f"After you stop sending PDFs for {DEBOUNCE_SECONDS} seconds, I will summarize all of them in the context of an oil market trader, focusing on key trading insights, market trends, and actionable information.\n\n"
         "You will receive a single audio message with the combined summary.\n\n"
         "Just send your PDFs to get started!"
     )
@@ -198,6 +347,11 @@ application = ApplicationBuilder().token(TOKEN).build()
 application.add_handler(CommandHandler("start", start))
 application.add_handler(MessageHandler(filters.Document.PDF, handle_document))
 
+# One long-lived event loop for the bot, so pending timers survive between webhook requests
+bot_loop = asyncio.new_event_loop()
+threading.Thread(target=bot_loop.run_forever, name="bot-loop", daemon=True).start()
+asyncio.run_coroutine_threadsafe(application.initialize(), bot_loop).result()
+
 # Health check endpoint
 @app.route("/health", methods=["GET"])
 def health():
@@ -208,20 +362,19 @@ def health():
 def webhook():
     if request.method == "POST":
         update = Update.de_json(request.get_json(force=True), application.bot)
-        asyncio.run(application.process_update(update))
+        asyncio.run_coroutine_threadsafe(application.process_update(update), bot_loop)
         return "ok"
     return "not allowed", 405
 
 # Deployment instructions (comments):
 # 1. Set TELEGRAM_BOT_TOKEN and WEBHOOK_URL as environment variables.
+#    Set OPENAI_API_KEY for summaries; OPENAI_MODEL optionally overrides the default gpt-4o-mini.
+#    For models not in MODEL_CONTEXT_TOKENS, set OPENAI_CONTEXT_TOKENS to their context size.
 # 2. Deploy this app to a public server (Heroku, Render, Railway, etc.).
 # 3. Register the webhook with Telegram:
 #    Use the following code once (can be run in a Python shell):
 #    from telegram import Bot
 #    Bot(TOKEN).set_webhook(url=WEBHOOK_URL + '/webhook')
-# 4. Ensure ./tmp directory exists for file storage.
 
 if __name__ == "__main__":
-    if not os.path.exists('./tmp'):
-        os.makedirs('./tmp')
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))